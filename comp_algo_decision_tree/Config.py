@@ -8,6 +8,7 @@ MAX_CACHED_HEAP_COUNT = 50
 MAX_CACHED_DECISION_TREES = 10
 SAMPLE_SEED = 514
 PROGRESS_INTERVAL_MS = 300
+PROGRESS_UPDATE_STEPS = 1024
 
 INPUT_N = 3
 INPUT_N_MAX = 500
@@ -7,7 +7,6 @@ from typing import Optional
 import dash_bootstrap_components as dbc
 import dash_cytoscape as cyto
 import dash_mantine_components as dmc
-import numpy as np
 import plotly.express as px
 import plotly.graph_objs as go
 from dash import Dash, Input, Output, State, callback, ctx, dash_table, dcc, html
@@ -131,7 +130,7 @@ def on_data(
     if buffered_input is None:
         buffered_input = [None]
     if trigger_id == "show_statistics" or buffered_input[0] == "show_statistics":
-        data = np.array(node_holder.operation_cnts, dtype=np.int32)
+        data = node_holder.operation_cnts
         ret.statistics_graph__figure = px.histogram(
             x=data, title="Operation Count Distribution", labels={"x": "Operation Count"}, color=data, text_auto=True
         )
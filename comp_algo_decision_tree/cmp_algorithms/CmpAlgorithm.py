@@ -4,7 +4,7 @@ from math import factorial
 from random import Random
 from typing import Any, NamedTuple, Optional, TypeVar
 
-from ..decision_tree_gen.DecisionTreeNode import DecisionTreeNode
+from ..decision_tree_gen.DecisionTreeNode import LETTERS, DecisionTreeNode
 
 
 def _sampler(N: int, r: Random) -> Generator[list[int], None, None]:
@@ -15,7 +15,7 @@ def _sampler(N: int, r: Random) -> Generator[list[int], None, None]:
 
 
 def _get_label(node: DecisionTreeNode[Sequence[int]], idx_use_letter: bool, crop_length: int) -> str:
-    ret = [f"({','.join(chr(ord('a') + x) if idx_use_letter else str(x) for x in node.idx_array)})"]
+    ret = [f"({','.join(LETTERS[x] if idx_use_letter else str(x) for x in node.idx_array)})"]
     if (tot_len := len(ret[0])) >= crop_length:
         return ret[0][: crop_length - 3] + "..."
     for val_array in node.val_arrays:
@@ -3,6 +3,8 @@ from weakref import proxy
 
 Container = TypeVar("Container")
 
+LETTERS = tuple(chr(ord("a") + i) for i in range(26))
+
 
 class DecisionTreeNode(Generic[Container]):
     def __init__(self, parent: Optional["DecisionTreeNode"] = None, is_left: bool = False) -> None:
@@ -13,13 +15,20 @@ class DecisionTreeNode(Generic[Container]):
         self.left: Optional[DecisionTreeNode] = None
         self.right: Optional[DecisionTreeNode] = None
         self.parent = None if parent is None else proxy(parent)
+        self.edge_data_cache: Optional[tuple[bool, dict]] = None
+        self.render_cache: Optional[dict[tuple, dict]] = None
+        self.label_cache: Optional[dict[int, str]] = None
 
     @property
     def is_left(self) -> bool:
         return self.parent.left is self
 
-    def edge_data(self, use_letter: bool) -> None:
-        x, y = [chr(ord("a") + x) if use_letter else f"[{x}]" for x in self.parent.cmp_xy[:2]]
-        return {"data": dict(source=str(self.parent.id), target=str(self.id), cmp_op=f"{x}<{y}" if self.is_left else f"{x}>{y}")}
+    def edge_data(self, use_letter: bool) -> dict:
+        "cached on the node since `use_letter` is fixed for a given tree, the returned dict should not be modified"
+        if self.edge_data_cache is None or self.edge_data_cache[0] != use_letter:
+            x, y = [LETTERS[x] if use_letter else f"[{x}]" for x in self.parent.cmp_xy[:2]]
+            edge_data = {"data": dict(source=str(self.parent.id), target=str(self.id), cmp_op=f"{x}<{y}" if self.is_left else f"{x}>{y}")}
+            self.edge_data_cache = (use_letter, edge_data)
+        return self.edge_data_cache[1]
 
-    __slots__ = ["id", "idx_array", "cmp_xy", "val_arrays", "left", "right", "parent", "__weakref__"]
+    __slots__ = ["id", "idx_array", "cmp_xy", "val_arrays", "left", "right", "parent", "edge_data_cache", "render_cache", "label_cache", "__weakref__"]
@@ -1,14 +1,14 @@
 import base64
+import binascii
 import time
 import traceback
 import zlib
-from collections import OrderedDict, deque
-from threading import Lock
-from typing import Optional
+from collections import OrderedDict
+from collections.abc import Iterable
+from threading import Event, Lock
+from typing import NamedTuple, Optional
 
-import atomics
 import numpy as np
-import sortednp as snp
 
 from ..cmp_algorithms.cmp_algorithms import cmp_algorithms
 from ..cmp_algorithms.CmpAlgorithm import CmpAlgorithm
@@ -16,149 +16,223 @@ from ..Config import *
 from .decision_tree import DecisionTreeNode, decision_tree
 
 
+NODE_CLASSES = ("", "is_leaf", "has_hidden_child")
+NO_CLASS, IS_LEAF, HAS_HIDDEN_CHILD = range(len(NODE_CLASSES))
+
+
 class NodeHolder:
     def __init__(self) -> None:
-        self.lock = Lock()
-        self.progress = atomics.atomic(8, atomics.INT)
-        self.initialize_scheduled = atomics.atomic(1, atomics.BYTES)
-        self.initialized_flag = atomics.atomic(1, atomics.BYTES)
+        self.initialize_scheduled = Lock()
+        self.initialized = Event()
+        self.error: Optional[Exception] = None
         self.set_progress(0, 1)
 
     def get_and_set_initialize_scheduled(self) -> bool:
-        return self.initialize_scheduled.bit_test_set(0, atomics.MemoryOrder.RELAXED)
+        "a non-blocking acquire works as an atomic test-and-set"
+        return not self.initialize_scheduled.acquire(blocking=False)
 
     def get_progress(self) -> tuple[int, int]:
-        x = self.progress.load(atomics.MemoryOrder.RELAXED)
-        return x >> 32, x & 0xFFFFFFFF
+        return self.progress
 
     def set_progress(self, i: int, total: int) -> None:
-        self.progress.store((i << 32) | total, atomics.MemoryOrder.RELAXED)
+        "the tuple is replaced as a whole, so readers never see `i` and `total` from different updates"
+        self.progress = (i, total)
 
     def set_progress_and_yield(self, i: int, total: int) -> None:
-        "yield current thread to avoid blocking http requests"
-        self.set_progress(i, total)
-        time.sleep(0)
+        "yield current thread to avoid blocking http requests, throttled to about `PROGRESS_UPDATE_STEPS` updates per build to keep the overhead low"
+        if i in (0, total) or i - self.progress[0] >= total / PROGRESS_UPDATE_STEPS:
+            self.set_progress(i, total)
+            time.sleep(0)
 
     def initialize(self, cmp_algorithm_i: int, N: int) -> None:
-        with self.lock:
+        try:
             self.cmp_algorithm = cmp_algorithms[cmp_algorithm_i]
             self.idx_use_letter = self.cmp_algorithm.idx_use_letter(N)
             print(f"init: `{self.cmp_algorithm.name}` with {N} elements")
             self._initialize(self.cmp_algorithm, N)
             print(f"fin:  `{self.cmp_algorithm.name}` with {N} elements")
-            self.initialized_flag.store(b"\x01", atomics.MemoryOrder.RELEASE)
+        except Exception as e:
+            traceback.print_exc()
+            self.error = e
+            self.set_progress(0, 1)
+            # the retry waits on a fresh event and only clears `error` once it succeeds, so waiters woken here still see this error;
+            # the schedule lock is released last so that no retry can start before the failure is fully recorded
+            failed, self.initialized = self.initialized, Event()
+            failed.set()
+            self.initialize_scheduled.release()
+            raise e
+        self.error = None
+        self.initialized.set()
 
     def wait_until_initialized(self) -> None:
-        if self.initialized_flag.load(atomics.MemoryOrder.ACQUIRE) == b"\x01":
-            return
-        with self.lock:
-            pass
+        "raises the error of a failed build, which has already been reset so that the next request schedules it again"
+        self.initialized.wait()
+        if self.error is not None:
+            raise self.error
 
     def _initialize(self, cmp_algorithm: CmpAlgorithm, N: int) -> None:
-        try:
-            self.nodes, self.operation_cnts, self.leaf_cnt = decision_tree(cmp_algorithm, N, self.set_progress_and_yield)
-        except Exception as e:
-            traceback.print_exc()
-            self.initialize_scheduled.store(b"\x00", atomics.MemoryOrder.RELEASE)
-            raise e
+        self.nodes, operation_cnts, self.leaf_cnt = decision_tree(cmp_algorithm, N, self.set_progress_and_yield)
+        self.operation_cnts = np.array(operation_cnts, dtype=np.int32)
+        self.left_ids = self._node_ids(node.left for node in self.nodes)
+        self.right_ids = self._node_ids(node.right for node in self.nodes)
+        self.parent_ids = self._node_ids(node.parent for node in self.nodes)
+        self.is_leaf = (self.left_ids == -1) & (self.right_ids == -1)
+        self.initial_visiblity_state = np.insert(self.descendant_ids(0, DISPLAY_DEPTH), 0, 0)
+        self.initial_visiblity_state.flags.writeable = False
+
+    def descendant_ids(self, node_id: int, max_depth: int) -> np.ndarray:
+        "node ids are assigned in BFS order, so the BFS levels come out sorted and are written one after another"
+        ret = np.empty((2 << max_depth) - 2, dtype=np.int32)
+        cnt = 0
+        Q = np.array([node_id], dtype=np.int32)
+        for _ in range(max_depth):
+            Q = np.column_stack((self.left_ids[Q], self.right_ids[Q])).ravel()
+            Q = Q[Q != -1]
+            ret[cnt : cnt + len(Q)] = Q
+            cnt += len(Q)
+        return ret[:cnt]
+
+    def _node_ids(self, nodes: Iterable[Optional[DecisionTreeNode]]) -> np.ndarray:
+        "pack the ids of the given nodes into an array indexed by node id, with `-1` standing for `None`"
+        return np.fromiter((-1 if node is None else node.id for node in nodes), dtype=np.int32, count=len(self.nodes))
+
+
+class CacheInfo(NamedTuple):
+    hits: int
+    misses: int
+    maxsize: Optional[int]
+    currsize: int
 
 
 class Nodes:
     cached: OrderedDict[tuple[int, int], NodeHolder] = OrderedDict()
     cached_lock = Lock()
+    cache_hits = 0
+    cache_misses = 0
 
     def __init__(self, node_holder: NodeHolder, visiblity_state: Optional[str], validate_visiblity_state: bool) -> None:
         self.node_holder = node_holder
-        if visiblity_state is not None:
-            self.visiblity_state = self.decode_visiblity(visiblity_state)
-            if validate_visiblity_state:
-                self.visiblity_state = self._validate_visiblity_state(self.visiblity_state)
-
+        self.encoded_visiblity_state: Optional[str] = None
+        tmp_visiblity_state = None if visiblity_state is None else self._try_decode_visiblity(visiblity_state)
+        if tmp_visiblity_state is None:
+            self.visiblity_state = self.node_holder.initial_visiblity_state
+        elif validate_visiblity_state:
+            self.visiblity_state = self._validate_visiblity_state(tmp_visiblity_state)
+            if np.array_equal(self.visiblity_state, tmp_visiblity_state):
+                self.encoded_visiblity_state = visiblity_state
         else:
-            self.visiblity_state = np.array([0], dtype=np.int32)
-            self.expand_children(self.node_holder.nodes[0])
+            self.visiblity_state = tmp_visiblity_state
+            self.encoded_visiblity_state = visiblity_state
+
+    def _try_decode_visiblity(self, visiblity_state: str) -> Optional[np.ndarray]:
+        "states that cannot be decoded (e.g. from an older encoding) or are empty are dropped, so that the initial state is used instead"
+        try:
+            ret = self.decode_visiblity(visiblity_state)
+        except (binascii.Error, zlib.error, ValueError):
+            return None
+        return ret if len(ret) else None
 
     def _validate_visiblity_state(self, tmp_visiblity_state: np.ndarray) -> np.ndarray:
-        valid = [0]
-        in_valid = {0}
-        for node_id in tmp_visiblity_state[1:]:
-            if node_id >= len(self.node_holder.nodes):
+        "a node is kept if its parent is the root or a kept node, the valid set grows one level per iteration"
+        candidates = tmp_visiblity_state[1:]
+        candidates = candidates[candidates < len(self.node_holder.nodes)]
+        if not len(candidates):
+            return np.zeros(1, dtype=np.int32)
+        parent_ids = self.node_holder.parent_ids[candidates]
+        parent_i = np.minimum(candidates.searchsorted(parent_ids), len(candidates) - 1)
+        parent_is_root = parent_ids == 0
+        parent_is_candidate = candidates[parent_i] == parent_ids
+        valid = parent_is_root
+        while True:
+            new_valid = parent_is_root | (parent_is_candidate & valid[parent_i])
+            if np.array_equal(new_valid, valid):
                 break
-            parent_id = self.node_holder.nodes[node_id].parent.id
-            if parent_id in in_valid:
-                valid.append(node_id)
-                in_valid.add(node_id)
-        return np.array(valid, dtype=np.int32)
+            valid = new_valid
+        return np.insert(candidates[valid], 0, 0)
 
     @classmethod
     def get_node_holder(cls, cmp_algorithm_i: int, N: int) -> NodeHolder:
         "the built-in `functools.lru_cache` would create multiple instances of NodeHolder for the same key when multithreading, so we use our own lru cache here"
         key = (cmp_algorithm_i, N)
+        # dict reads are atomic, so the lookup is done without the lock and checked again under it before inserting
+        if (ret := cls.cached.get(key)) is None:
+            new_node_holder = NodeHolder()
+            with cls.cached_lock:
+                if (ret := cls.cached.get(key)) is None:
+                    if MAX_CACHED_DECISION_TREES is not None and len(cls.cached) >= MAX_CACHED_DECISION_TREES:
+                        cls.cached.popitem(last=False)
+                    cls.cached[key] = new_node_holder
+                    cls.cache_misses += 1
+                    return new_node_holder
         with cls.cached_lock:
             if key in cls.cached:
                 cls.cached.move_to_end(key)
-                return next(reversed(cls.cached.values()))
-            if MAX_CACHED_DECISION_TREES is not None and len(cls.cached) >= MAX_CACHED_DECISION_TREES:
-                cls.cached.popitem(last=False)
-            ret = NodeHolder()
-            cls.cached[key] = ret
-            return ret
+            cls.cache_hits += 1
+        return ret
+
+    @classmethod
+    def cache_info(cls) -> CacheInfo:
+        "same fields as `functools.lru_cache`'s `cache_info()`"
+        with cls.cached_lock:
+            return CacheInfo(cls.cache_hits, cls.cache_misses, MAX_CACHED_DECISION_TREES, len(cls.cached))
 
     def get_visiblity_state(self) -> str:
-        return self.encode_visiblity(self.visiblity_state)
+        "the encoded state is cached until the next mutation, since most callbacks do not change the visiblity"
+        if self.encoded_visiblity_state is None:
+            self.encoded_visiblity_state = self.encode_visiblity(self.visiblity_state)
+        return self.encoded_visiblity_state
 
     @staticmethod
     def encode_visiblity(visiblity: np.ndarray) -> str:
-        return base64.b85encode(zlib.compress(visiblity.tobytes())).decode()
+        "the visible node ids are stored as a bitset, which compresses much better than the int32 array itself"
+        bits = np.zeros(visiblity[-1] + 1, dtype=np.uint8)
+        bits[visiblity] = 1
+        return base64.b64encode(zlib.compress(np.packbits(bits).tobytes(), 1)).decode()
 
     @staticmethod
     def decode_visiblity(visiblity: str) -> np.ndarray:
-        return np.frombuffer(zlib.decompress(base64.b85decode(visiblity)), dtype=np.int32)
+        bits = np.unpackbits(np.frombuffer(zlib.decompress(base64.b64decode(visiblity)), dtype=np.uint8))
+        return np.flatnonzero(bits).astype(np.int32)
 
     def node_id_visiblity(self, node_id: int) -> bool:
         i = self.visiblity_state.searchsorted(node_id)
         return i < len(self.visiblity_state) and self.visiblity_state[i] == node_id
 
+    def node_ids_visiblity(self, node_ids: np.ndarray) -> np.ndarray:
+        i = self.visiblity_state.searchsorted(node_ids)
+        return self.visiblity_state[np.minimum(i, len(self.visiblity_state) - 1)] == node_ids
+
     def node_visiblity(self, node: DecisionTreeNode) -> bool:
         return self.node_id_visiblity(node.id)
 
     def node_has_hidden_child(self, node: DecisionTreeNode) -> bool:
-        for child in (node.left, node.right):
-            if child is not None and not self.node_visiblity(child):
+        for child_id in (self.node_holder.left_ids[node.id], self.node_holder.right_ids[node.id]):
+            if child_id != -1 and not self.node_id_visiblity(child_id):
                 return True
         return False
 
     def node_is_leaf(self, node: DecisionTreeNode) -> bool:
-        return node.left is None and node.right is None
+        return self.node_holder.is_leaf[node.id]
 
     def expand_children(self, node: DecisionTreeNode) -> None:
-        update: list[int] = []
-        Q = deque([node])
-        depth = 1
-        while Q:
-            for _ in range(len(Q)):
-                node = Q.popleft()
-                for child in (node.left, node.right):
-                    if child is not None:
-                        update.append(child.id)
-                        if depth < DISPLAY_DEPTH:
-                            Q.append(child)
-            depth += 1
-        update = np.array(update, dtype=np.int32)
-        self.visiblity_state = snp.merge(self.visiblity_state, update, duplicates=snp.DROP)
+        update = self.node_holder.descendant_ids(node.id, DISPLAY_DEPTH)
+        i = self.visiblity_state.searchsorted(update)
+        is_new = self.visiblity_state[np.minimum(i, len(self.visiblity_state) - 1)] != update
+        self.visiblity_state = np.insert(self.visiblity_state, i[is_new], update[is_new])
+        self.encoded_visiblity_state = None
 
     def hide_children(self, node: DecisionTreeNode) -> None:
-        deletes: list[int] = []
-        Q = deque([node])
-        while Q:
-            node = Q.popleft()
-            for child in (node.left, node.right):
-                if child is not None:
-                    i = self.visiblity_state.searchsorted(child.id)
-                    if i < len(self.visiblity_state) and self.visiblity_state[i] == child.id:
-                        deletes.append(i)
-                        Q.append(child)
-        self.visiblity_state = np.delete(self.visiblity_state, deletes)
+        deletes = np.empty(len(self.visiblity_state), dtype=np.int32)
+        cnt = 0
+        Q = np.array([node.id], dtype=np.int32)
+        while len(Q):
+            children = np.concatenate((self.node_holder.left_ids[Q], self.node_holder.right_ids[Q]))
+            children = children[children != -1]
+            Q = children[self.node_ids_visiblity(children)]
+            deletes[cnt : cnt + len(Q)] = Q
+            cnt += len(Q)
+        self.visiblity_state = self.visiblity_state[~np.isin(self.visiblity_state, deletes[:cnt], assume_unique=True)]
+        self.encoded_visiblity_state = None
 
     def on_tap_node(self, node_id: int) -> None:
         if node_id >= len(self.node_holder.nodes) or not self.node_id_visiblity(node_id):
@@ -172,32 +246,40 @@ class Nodes:
             self.hide_children(node)
 
     def expand_all(self) -> bool:
-        elem: list[int] = []
-        Q = deque([self.node_holder.nodes[0]])
-        tot = 1
-        while Q and tot < MAX_ELEMENTS:
-            node = Q.popleft()
-            elem.append(node.id)
-            for child in (node.left, node.right):
-                if tot < MAX_ELEMENTS and child is not None:
-                    tot += 1
-                    Q.append(child)
-        self.visiblity_state = np.array(elem, dtype=np.int32)
-        return tot < MAX_ELEMENTS
+        "BFS from the root pops the nodes in id order, and stops as soon as `MAX_ELEMENTS` nodes have been pushed"
+        child_cnts = (self.node_holder.left_ids[:MAX_ELEMENTS] != -1).astype(np.int32) + (self.node_holder.right_ids[:MAX_ELEMENTS] != -1)
+        exceeded = 1 + np.cumsum(child_cnts) >= MAX_ELEMENTS
+        complete = not exceeded.any()
+        elem_cnt = len(self.node_holder.nodes) if complete else int(np.argmax(exceeded)) + 1
+        self.visiblity_state = np.arange(elem_cnt, dtype=np.int32)
+        self.encoded_visiblity_state = None
+        return complete
+
+    def node_label(self, node: DecisionTreeNode, crop_length: int) -> str:
+        "labels do not depend on the visiblity, so they are built on first render and cached on the node separately"
+        if node.label_cache is None:
+            node.label_cache = {}
+        if (label := node.label_cache.get(crop_length)) is None:
+            label = self.node_holder.cmp_algorithm.get_label(node, self.node_holder.idx_use_letter, crop_length)
+            node.label_cache[crop_length] = label
+        return label
 
     def visible_elements(self, show_full_labels: bool) -> list[dict]:
+        "the returned dicts are cached on the nodes and shared between calls, so they should not be modified"
+        left_ids = self.node_holder.left_ids[self.visiblity_state]
+        right_ids = self.node_holder.right_ids[self.visiblity_state]
+        is_leaf = self.node_holder.is_leaf[self.visiblity_state]
+        has_hidden_child = ((left_ids != -1) & ~self.node_ids_visiblity(left_ids)) | ((right_ids != -1) & ~self.node_ids_visiblity(right_ids))
+        node_classes = np.where(is_leaf, IS_LEAF, np.where(has_hidden_child, HAS_HIDDEN_CHILD, NO_CLASS))
         ret = []
-        for node_id in self.visiblity_state:
+        for node_id, node_class in zip(self.visiblity_state.tolist(), node_classes.tolist()):
             node: DecisionTreeNode = self.node_holder.nodes[node_id]
-            classes = []
-            if self.node_is_leaf(node):
-                classes.append("is_leaf")
-            elif self.node_has_hidden_child(node):
-                classes.append("has_hidden_child")
-            label = self.node_holder.cmp_algorithm.get_label(
-                node, self.node_holder.idx_use_letter, LABEL_MAX_LENGTH if show_full_labels else LABEL_CROP_LENGTH
-            )
-            node_data = {"data": {"id": str(node.id), "label": label}, "classes": " ".join(classes)}
+            if node.render_cache is None:
+                node.render_cache = {}
+            if (node_data := node.render_cache.get((show_full_labels, node_class))) is None:
+                label = self.node_label(node, LABEL_MAX_LENGTH if show_full_labels else LABEL_CROP_LENGTH)
+                node_data = {"data": {"id": str(node.id), "label": label}, "classes": NODE_CLASSES[node_class]}
+                node.render_cache[(show_full_labels, node_class)] = node_data
             ret.append(node_data)
             if node.parent is not None:
                 ret.append(node.edge_data(self.node_holder.idx_use_letter))